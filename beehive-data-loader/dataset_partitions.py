@@ -0,0 +1,126 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+#
+# dataset_partitions lists the (node_id, date) partitions of each data table and
+# is kept up to date by the loaders. dataset_partition_counts optionally holds
+# their row counts. both are partitioned by month and clustered by date.
+import datetime
+import sys
+import time
+
+
+def create_tables(session):
+    session.execute('''
+    CREATE TABLE IF NOT EXISTS waggle.dataset_partitions (
+      table_name ascii,
+      month ascii,
+      date ascii,
+      node_id text,
+      last_write timestamp,
+      PRIMARY KEY ((table_name, month), date, node_id)
+    )
+    ''')
+
+    session.execute('''
+    CREATE TABLE IF NOT EXISTS waggle.dataset_partition_counts (
+      table_name ascii,
+      month ascii,
+      date ascii,
+      node_id text,
+      row_count counter,
+      PRIMARY KEY ((table_name, month), date, node_id)
+    )
+    ''')
+
+
+# keeps dataset_partitions up to date with the partitions being written. each
+# partition is updated at most once per interval, with row counts accumulated
+# in between.
+class PartitionIndex:
+
+    def __init__(self, session, table, interval, counts):
+        self.session = session
+        self.table = table
+        self.interval = interval
+        self.update_query = session.prepare('''
+        UPDATE waggle.dataset_partitions SET last_write = ?
+        WHERE table_name = ? AND month = ? AND date = ? AND node_id = ?
+        ''')
+        self.count_query = None
+
+        if counts:
+            self.count_query = session.prepare('''
+            UPDATE waggle.dataset_partition_counts SET row_count = row_count + ?
+            WHERE table_name = ? AND month = ? AND date = ? AND node_id = ?
+            ''')
+
+        self.updated = {}
+        self.counts = {}
+        self.last_prune = time.monotonic()
+
+    # key is the partition's (node_id, date) and rows the number of rows just
+    # written to it.
+    def add(self, key, rows=1):
+        now = time.monotonic()
+
+        if self.count_query is not None:
+            self.counts[key] = self.counts.get(key, 0) + rows
+
+        if now - self.last_prune > self.interval:
+            self.prune(now)
+
+        if key in self.updated and now - self.updated[key] < self.interval:
+            return
+
+        self.updated[key] = now
+        self.write(key)
+
+    def write(self, key):
+        node_id, date = key
+        partition = (self.table, date[:7], date, node_id)
+
+        futures = [self.session.execute_async(self.update_query, (datetime.datetime.utcnow(),) + partition)]
+        count = self.counts.pop(key, 0)
+
+        if count > 0:
+            futures.append(self.session.execute_async(self.count_query, (count,) + partition))
+
+        for future in futures:
+            future.add_errback(index_write_failed)
+
+        return futures
+
+    # forgets partitions which haven't been written for an interval, after
+    # writing out their remaining counts.
+    def prune(self, now):
+        for key, updated in list(self.updated.items()):
+            if now - updated < self.interval:
+                continue
+
+            if key in self.counts:
+                self.write(key)
+
+            del self.updated[key]
+
+        self.last_prune = now
+
+    # writes out remaining counts and waits for them before shutdown.
+    def flush(self):
+        futures = []
+
+        for key in list(self.counts):
+            futures.extend(self.write(key))
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+
+def index_write_failed(exc):
+    print('index write failed', repr(exc), file=sys.stderr, flush=True)
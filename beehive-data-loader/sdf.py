@@ -0,0 +1,125 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+import csv
+import gzip
+from io import StringIO
+
+
+# ids with a 0x prefix are hex and all others are decimal, as in the v2
+# exporters. apply-sdf used to parse every id as hex, so the decimal ids in
+# sdf.csv (900 spl, 1000 image_detector, 2000 rune, 2100 nai_detector) never
+# matched and their rows kept the numeric ids. they're now named.
+def parse_int_string(s):
+    if s.startswith('0x'):
+        return int(s, 16)
+    return int(s)
+
+
+def load_sdf_file(path):
+    results = []
+
+    with open(path) as file:
+        reader = csv.DictReader(file)
+
+        for row in reader:
+            results.append({
+                'sensor_id': parse_int_string(row['sensor_id']),
+                'sensor_name': row['sensor_name'].strip(),
+                'parameter_id': parse_int_string(row['parameter_id']),
+                'parameter_name': row['parameter_name'].strip(),
+            })
+
+    return results
+
+
+def encode_csv_fields(fields):
+    buf = StringIO()
+    csv.writer(buf, lineterminator='').writerow(fields)
+    return buf.getvalue().encode()
+
+
+class SDF:
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.names = {}
+
+        for r in entries:
+            self.names[(r['sensor_id'], r['parameter_id'])] = (r['sensor_name'], r['parameter_name'])
+
+        # maps the raw sensor and parameter id fields of a row to its already
+        # csv encoded names. ids are added as they are seen, so differently
+        # formatted ids (eg. 3 vs 03) each get their own entry.
+        self.encoded_names = {}
+
+    def lookup(self, sensor_id, parameter_id):
+        try:
+            return self.names[(sensor_id, parameter_id)]
+        except KeyError:
+            return sensor_id, parameter_id
+
+    def encode_names(self, sensor_field, parameter_field):
+        key = (sensor_field, parameter_field)
+
+        try:
+            return self.encoded_names[key]
+        except KeyError:
+            pass
+
+        sensor_id = int(sensor_field)
+        parameter_id = int(parameter_field)
+        encoded = encode_csv_fields(self.lookup(sensor_id, parameter_id))
+        self.encoded_names[key] = encoded
+        return encoded
+
+    # enriches a timestamp,node_id,sub_id,sensor_id,parameter_id,value row.
+    # the first five fields never contain commas, so the value is passed
+    # through as is.
+    def enrich_line(self, line):
+        fields = line.split(b',', 5)
+
+        if len(fields) != 6:
+            return line
+
+        try:
+            names = self.encode_names(fields[3], fields[4])
+        except ValueError:
+            return line
+
+        return b','.join((fields[0], fields[1], fields[2], names, fields[5]))
+
+    def enrich_chunk(self, chunk):
+        return b''.join(map(self.enrich_line, chunk.splitlines(keepends=True)))
+
+
+def open_input(file):
+    if file.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=file)
+    return file
+
+
+def read_chunks(file, chunk_size):
+    remainder = b''
+
+    while True:
+        data = file.read(chunk_size)
+
+        if not data:
+            break
+
+        data = remainder + data
+        end = data.rfind(b'\n') + 1
+
+        if end == 0:
+            remainder = data
+            continue
+
+        yield data[:end]
+        remainder = data[end:]
+
+    if remainder:
+        yield remainder
@@ -5,10 +5,29 @@ from cassandra.cluster import Cluster
 #  license.  For more details on the Waggle project, visit:
 #           http://www.wa8.gl
 # ANL:waggle-license
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType
+from collections import deque
 from datetime import datetime
+import argparse
+import multiprocessing
 import pika
 import os
+import sys
 import binascii
+import functools
+import pickle
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+import random
+import signal
+import threading
+import time
+from spool import Spool, read_segment
+
+# dataset_partitions is shared with the data loader. it's copied next to
+# loader.py when building the image.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'beehive-data-loader'))
+import dataset_partitions
 
 RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
 RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', '5672'))
@@ -16,14 +35,73 @@ RABBITMQ_USERNAME = os.environ.get('RABBITMQ_USERNAME', 'loader_raw')
 RABBITMQ_PASSWORD = os.environ.get('RABBITMQ_PASSWORD', 'waggle')
 CASSANDRA_HOSTS = os.environ.get('CASSANDRA_HOSTS', 'cassandra').split()
 BEEHIVE_DEPLOYMENT = os.environ.get('BEEHIVE_DEPLOYMENT', '/')
+# max number of unacked deliveries. used as prefetch count.
+LOADER_MAX_INFLIGHT = int(os.environ.get('LOADER_MAX_INFLIGHT', '1024'))
+# a window of deliveries is written once it has this many deliveries...
+LOADER_BATCH_SIZE = int(os.environ.get('LOADER_BATCH_SIZE', '128'))
+# ...or once this many seconds have passed since its first delivery.
+LOADER_BATCH_INTERVAL = float(os.environ.get('LOADER_BATCH_INTERVAL', '0.05'))
+# keep batches well under cassandra's batch_size_fail_threshold_in_kb (50kb by default).
+LOADER_BATCH_MAX_BYTES = int(os.environ.get('LOADER_BATCH_MAX_BYTES', '32768'))
+# storage format of message bodies. hex writes hex encoded ascii to sensor_data_raw and
+# blob writes bytes to sensor_data_raw_blob.
+LOADER_DATA_FORMAT = os.environ.get('LOADER_DATA_FORMAT', 'hex')
+LOADER_WORKERS = int(os.environ.get('LOADER_WORKERS', '1'))
+# max number of seconds a stopping worker waits for its writes to finish.
+LOADER_DRAIN_TIMEOUT = float(os.environ.get('LOADER_DRAIN_TIMEOUT', '8'))
 
-cluster = Cluster(contact_points=CASSANDRA_HOSTS)
-session = cluster.connect('waggle')
-query = 'INSERT INTO sensor_data_raw (node_id, date, plugin_name, plugin_version, plugin_instance, timestamp, parameter, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
-prepared = session.prepare(query)
+tables = {
+    'hex': 'sensor_data_raw',
+    'blob': 'sensor_data_raw_blob',
+}
+# directory for the local write-ahead spool. spooling is disabled if empty.
+LOADER_SPOOL_DIR = os.environ.get('LOADER_SPOOL_DIR', '')
+# write latency in seconds above which windows are spooled instead of written.
+LOADER_SPOOL_THRESHOLD = float(os.environ.get('LOADER_SPOOL_THRESHOLD', '2'))
+LOADER_SPOOL_SEGMENT_SIZE = int(os.environ.get('LOADER_SPOOL_SEGMENT_SIZE', str(64 * 1024 * 1024)))
+# max number of spooled rows replayed into cassandra per second.
+LOADER_SPOOL_REPLAY_RATE = int(os.environ.get('LOADER_SPOOL_REPLAY_RATE', '1000'))
+# port of the prometheus metrics endpoint. worker N listens on port + N. disabled if 0.
+LOADER_METRICS_PORT = int(os.environ.get('LOADER_METRICS_PORT', '0'))
+# fraction of written messages to print.
+LOADER_LOG_SAMPLE = float(os.environ.get('LOADER_LOG_SAMPLE', '0'))
+# min number of seconds between dataset_partitions updates for a partition. disabled if 0.
+LOADER_INDEX_INTERVAL = float(os.environ.get('LOADER_INDEX_INTERVAL', '60'))
+# also keep row counts in dataset_partition_counts if 1.
+LOADER_INDEX_COUNTS = os.environ.get('LOADER_INDEX_COUNTS', '0') == '1'
 
+messages_total = Counter('loader_messages_total', 'Number of messages written and acked.')
+messages_failed_total = Counter('loader_messages_failed_total', 'Number of messages nacked after a failed write.')
+messages_spooled_total = Counter('loader_messages_spooled_total', 'Number of messages written to the spool.')
+node_messages_total = Counter('loader_node_messages_total', 'Number of messages written and acked per node.', ['node_id'])
+inflight_messages = Gauge('loader_inflight_messages', 'Number of unacked messages.')
+spooling_gauge = Gauge('loader_spooling', 'Whether writes are currently being spooled.')
+write_latency = Histogram('loader_write_latency_seconds', 'Cassandra write latency.',
+                          buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+lag = Histogram('loader_lag_seconds', 'Time from message timestamp to ack.',
+                buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
 
-def process_message(ch, method, properties, body):
+query = 'INSERT INTO {} (node_id, date, plugin_name, plugin_version, plugin_instance, timestamp, parameter, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(tables[LOADER_DATA_FORMAT])
+
+
+class Window:
+
+    def __init__(self):
+        self.deliveries = []
+        self.pending = 0
+        self.failed = set()
+        self.timer = None
+
+
+partition_index = None
+
+
+# windows which have been written, in delivery order. since acks use
+# multiple=True, windows are only finalized once all earlier ones are.
+windows = deque()
+
+
+def decode_message(properties, body):
     versionStrings = properties.app_id.split(':')
     sampleDatetime = datetime.utcfromtimestamp(float(properties.timestamp) / 1000.0)
     sampleDate = sampleDatetime.strftime('%Y-%m-%d')
@@ -34,27 +112,365 @@ def process_message(ch, method, properties, body):
     plugin_instance = '0' if (len(versionStrings) < 3) else versionStrings[2]
     timestamp = int(properties.timestamp)
     parameter = properties.type
-    data = binascii.hexlify(body).decode()
-
-    session.execute(prepared, (node_id, sampleDate, plugin_name, plugin_version, plugin_instance, timestamp, parameter, data))
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-    print(node_id, timestamp, plugin_name, plugin_version, parameter, flush=True)
-
-
-connection = pika.BlockingConnection(pika.ConnectionParameters(
-    host=RABBITMQ_HOST,
-    port=RABBITMQ_PORT,
-    virtual_host=BEEHIVE_DEPLOYMENT,
-    credentials=pika.PlainCredentials(
-        username=RABBITMQ_USERNAME,
-        password=RABBITMQ_PASSWORD,
-    ),
-    connection_attempts=10,
-    retry_delay=3.0))
-
-channel = connection.channel()
-# channel.basic_qos(prefetch_count=1)
-queue = 'db-raw'
-channel.basic_consume(queue, process_message)
-channel.start_consuming()
+    data = body if LOADER_DATA_FORMAT == 'blob' else binascii.hexlify(body).decode()
+    return (node_id, sampleDate, plugin_name, plugin_version, plugin_instance, timestamp, parameter, data)
+
+
+def process_message(ch, method, properties, body):
+    if not window.deliveries:
+        window.timer = connection.call_later(LOADER_BATCH_INTERVAL, flush_window)
+
+    window.deliveries.append((method.delivery_tag, decode_message(properties, body)))
+    inflight_messages.inc()
+
+    if len(window.deliveries) >= LOADER_BATCH_SIZE:
+        flush_window()
+
+
+def group_by_partition(deliveries):
+    groups = {}
+
+    for delivery_tag, row in deliveries:
+        key = (row[0], row[1])
+
+        if key not in groups:
+            groups[key] = []
+
+        groups[key].append((delivery_tag, row))
+
+    return groups.values()
+
+
+def split_by_size(deliveries):
+    chunk = []
+    chunk_size = 0
+
+    for delivery_tag, row in deliveries:
+        row_size = len(row[-1])
+
+        if chunk and chunk_size + row_size > LOADER_BATCH_MAX_BYTES:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+
+        chunk.append((delivery_tag, row))
+        chunk_size += row_size
+
+    if chunk:
+        yield chunk
+
+
+def make_statement(chunk):
+    if len(chunk) == 1:
+        return prepared.bind(chunk[0][1])
+
+    # all rows in the chunk share a partition key, so an unlogged batch is
+    # applied as a single mutation by the coordinator.
+    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+
+    for _, row in chunk:
+        batch.add(prepared, row)
+
+    return batch
+
+
+def flush_window():
+    global window
+
+    w = window
+    window = Window()
+
+    if w.timer is not None:
+        connection.remove_timeout(w.timer)
+
+    if not w.deliveries:
+        return
+
+    windows.append(w)
+
+    if spooling:
+        spool_deliveries(w, w.deliveries)
+        finalize_windows()
+        return
+
+    for group in group_by_partition(w.deliveries):
+        for chunk in split_by_size(group):
+            w.pending += 1
+            future = session.execute_async(make_statement(chunk))
+            future.add_callbacks(
+                callback=write_done, callback_args=(w, chunk, time.monotonic()),
+                errback=write_done, errback_args=(w, chunk, time.monotonic()))
+
+
+# NOTE write callbacks run on the cassandra driver's event loop thread, so
+# completion is handed back to the connection's thread.
+def write_done(result, w, chunk, start):
+    connection.add_callback_threadsafe(functools.partial(window_write_done, w, chunk, start, result))
+
+
+def window_write_done(w, chunk, start, result):
+    w.pending -= 1
+    latency = time.monotonic() - start
+    write_latency.observe(latency)
+
+    if isinstance(result, Exception):
+        if spool is not None:
+            print('write failed', len(chunk), 'messages', repr(result), '- spooling', flush=True)
+            spool_deliveries(w, chunk)
+            start_spooling()
+        else:
+            w.failed.update(delivery_tag for delivery_tag, _ in chunk)
+            print('write failed', len(chunk), 'messages', repr(result), flush=True)
+    elif spool is not None and latency > LOADER_SPOOL_THRESHOLD:
+        print('write latency', round(latency, 3), 's', flush=True)
+        start_spooling()
+
+    finalize_windows()
+
+
+# spooled deliveries are acked once they have been flushed to the spool.
+def spool_deliveries(w, deliveries):
+    try:
+        spool.append(pickle.dumps(row) for _, row in deliveries)
+        spool.flush()
+        messages_spooled_total.inc(len(deliveries))
+    except OSError as exc:
+        w.failed.update(delivery_tag for delivery_tag, _ in deliveries)
+        print('spool failed', len(deliveries), 'messages', repr(exc), flush=True)
+
+
+def start_spooling():
+    global spooling
+
+    if not spooling:
+        print('spooling writes', flush=True)
+        spooling = True
+        spooling_gauge.set(1)
+
+
+def stop_spooling():
+    global spooling
+
+    if spooling:
+        print('resuming writes', flush=True)
+        spooling = False
+        spooling_gauge.set(0)
+
+
+def chunked(items, size):
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def replay_segment(path):
+    for payloads in chunked(read_segment(path), LOADER_SPOOL_REPLAY_RATE):
+        chunk_start = time.monotonic()
+        rows = [pickle.loads(payload) for payload in payloads]
+
+        # the first row is written on its own to probe the write latency.
+        start = time.monotonic()
+        session.execute(prepared, rows[0])
+
+        if time.monotonic() - start < LOADER_SPOOL_THRESHOLD:
+            connection.add_callback_threadsafe(stop_spooling)
+
+        execute_concurrent_with_args(session, prepared, rows[1:], concurrency=64)
+
+        time.sleep(max(0, 1 - (time.monotonic() - chunk_start)))
+
+
+# replays spooled segments into cassandra. rows are upserts, so replaying part
+# of a segment again after a failure or restart is harmless.
+def replay_spool():
+    while True:
+        path = spool.next_segment()
+
+        if path is None:
+            time.sleep(1)
+            continue
+
+        try:
+            replay_segment(path)
+        except Exception as exc:
+            print('replay failed', path, repr(exc), flush=True)
+            time.sleep(5)
+            continue
+
+        spool.remove_segment(path)
+        print('replayed', path, flush=True)
+
+
+def finalize_windows():
+    while windows and windows[0].pending == 0:
+        w = windows.popleft()
+
+        if not w.failed:
+            channel.basic_ack(delivery_tag=w.deliveries[-1][0], multiple=True)
+        else:
+            for delivery_tag, _ in w.deliveries:
+                if delivery_tag in w.failed:
+                    channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+                else:
+                    channel.basic_ack(delivery_tag=delivery_tag)
+
+        inflight_messages.dec(len(w.deliveries))
+        messages_failed_total.inc(len(w.failed))
+        now = time.time()
+
+        for delivery_tag, row in w.deliveries:
+            if delivery_tag in w.failed:
+                continue
+
+            node_id, date, plugin_name, plugin_version, _, timestamp, parameter, _ = row
+            messages_total.inc()
+            node_messages_total.labels(node_id).inc()
+            lag.observe(now - timestamp / 1000)
+
+            if partition_index is not None:
+                partition_index.add((node_id, date))
+
+            if LOADER_LOG_SAMPLE > 0 and random.random() < LOADER_LOG_SAMPLE:
+                print(node_id, timestamp, plugin_name, plugin_version, parameter, flush=True)
+
+
+def connect_rabbitmq():
+    return pika.BlockingConnection(pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        virtual_host=BEEHIVE_DEPLOYMENT,
+        credentials=pika.PlainCredentials(
+            username=RABBITMQ_USERNAME,
+            password=RABBITMQ_PASSWORD,
+        ),
+        connection_attempts=10,
+        retry_delay=3.0))
+
+
+def stop_consuming(signum, frame):
+    connection.add_callback_threadsafe(channel.stop_consuming)
+
+
+def run_worker(index=0):
+    global cluster
+    global session
+    global prepared
+    global connection
+    global channel
+    global window
+    global spool
+    global spooling
+    global partition_index
+
+    # workers are forked from the supervisor, so drop its signal handlers
+    # until there is something to drain.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # each worker owns its connections. the cassandra driver is not fork-safe,
+    # so nothing can be shared with the supervisor.
+    cluster = Cluster(contact_points=CASSANDRA_HOSTS)
+    session = cluster.connect('waggle')
+    prepared = session.prepare(query)
+
+    if LOADER_INDEX_INTERVAL > 0:
+        # the index tables may not exist yet on clusters set up before they
+        # were added to init.cql.
+        dataset_partitions.create_tables(session)
+        partition_index = dataset_partitions.PartitionIndex(session, tables[LOADER_DATA_FORMAT], LOADER_INDEX_INTERVAL, LOADER_INDEX_COUNTS)
+
+    connection = connect_rabbitmq()
+    channel = connection.channel()
+    window = Window()
+    spool = None
+    spooling = False
+    spooling_gauge.set(0)
+
+    if LOADER_SPOOL_DIR:
+        spool = Spool(os.path.join(LOADER_SPOOL_DIR, 'worker-{}'.format(index)), LOADER_SPOOL_SEGMENT_SIZE)
+        threading.Thread(target=replay_spool, daemon=True).start()
+
+    if LOADER_METRICS_PORT:
+        start_http_server(LOADER_METRICS_PORT + index)
+
+    signal.signal(signal.SIGTERM, stop_consuming)
+    signal.signal(signal.SIGINT, stop_consuming)
+
+    # bounds the number of unacked deliveries and therefore the number of writes in flight
+    channel.basic_qos(prefetch_count=LOADER_MAX_INFLIGHT)
+    queue = 'db-raw'
+    channel.basic_consume(queue, process_message)
+    channel.start_consuming()
+
+    # drain the partial window and in flight writes before closing. any
+    # remaining unacked deliveries are requeued by the broker on close.
+    flush_window()
+    deadline = time.monotonic() + LOADER_DRAIN_TIMEOUT
+
+    while windows and time.monotonic() < deadline:
+        connection.process_data_events(time_limit=0.1)
+
+    if partition_index is not None:
+        partition_index.flush()
+
+    # unreplayed spool segments are picked up by the next worker with this index.
+    if spool is not None:
+        spool.close()
+
+    connection.close()
+    cluster.shutdown()
+
+
+def supervise(workers):
+    processes = [None] * workers
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+        for p in processes:
+            if p is not None and p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        for i, p in enumerate(processes):
+            if p is not None and p.is_alive():
+                continue
+
+            if p is not None:
+                print('worker', i, 'exited with', p.exitcode, '- restarting', flush=True)
+
+            processes[i] = multiprocessing.Process(target=run_worker, args=(i,), name='loader-worker-{}'.format(i))
+            processes[i].start()
+
+        time.sleep(1)
+
+    for p in processes:
+        p.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=LOADER_WORKERS, help='Number of consumer processes to run.')
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        run_worker()
+    else:
+        supervise(args.workers)
+
+
+if __name__ == '__main__':
+    main()
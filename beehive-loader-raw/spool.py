@@ -0,0 +1,137 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Records are appended to fixed size, memory mapped segment files as:
+#
+#   length (uint32) | crc32 of payload (uint32) | payload
+#
+# Unused space at the end of a segment is zero, so a zero length marks the end
+# of the segment. A record with a bad checksum (for example, from a crash
+# during a write) also ends the segment.
+record_header = struct.Struct('<II')
+
+
+class Segment:
+
+    def __init__(self, path, size):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.offset = 0
+
+    def fits(self, size):
+        return self.offset + size <= len(self.mmap)
+
+    def append(self, payload):
+        record_header.pack_into(self.mmap, self.offset, len(payload), zlib.crc32(payload))
+        start = self.offset + record_header.size
+        self.mmap[start:start + len(payload)] = payload
+        self.offset = start + len(payload)
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.flush()
+        self.mmap.close()
+        self.file.close()
+
+
+class Spool:
+
+    def __init__(self, path, segment_size):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.active = None
+
+        # segments left over from a previous run are replayed first.
+        self.sealed = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.seg'))
+
+        if self.sealed:
+            self.next_id = int(os.path.basename(self.sealed[-1]).split('.')[0]) + 1
+        else:
+            self.next_id = 0
+
+    def append(self, payloads):
+        with self.lock:
+            for payload in payloads:
+                size = record_header.size + len(payload)
+
+                if self.active is None or not self.active.fits(size):
+                    self._seal()
+                    path = os.path.join(self.path, '{:016d}.seg'.format(self.next_id))
+                    self.next_id += 1
+                    self.active = Segment(path, max(self.segment_size, size))
+
+                self.active.append(payload)
+
+    def flush(self):
+        with self.lock:
+            if self.active is not None:
+                self.active.flush()
+
+    def next_segment(self):
+        with self.lock:
+            if not self.sealed and self.active is not None and self.active.offset > 0:
+                self._seal()
+            if self.sealed:
+                return self.sealed[0]
+            return None
+
+    def remove_segment(self, path):
+        with self.lock:
+            self.sealed.remove(path)
+            os.remove(path)
+
+    def close(self):
+        with self.lock:
+            self._seal()
+
+    def _seal(self):
+        if self.active is None:
+            return
+
+        self.active.close()
+
+        if self.active.offset > 0:
+            self.sealed.append(self.active.path)
+        else:
+            os.remove(self.active.path)
+
+        self.active = None
+
+
+def read_segment(path):
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+
+            while offset + record_header.size <= len(data):
+                length, crc = record_header.unpack_from(data, offset)
+
+                if length == 0:
+                    break
+
+                start = offset + record_header.size
+                payload = data[start:start + length]
+
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+
+                yield payload
+                offset = start + length
@@ -0,0 +1,264 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+#
+# columnar copies of the csv datasets, so tools can load a node-day without
+# parsing text. each holds the columns:
+#
+# timestamp   int64 seconds since the epoch
+# subsystem   dictionary encoded string
+# sensor      dictionary encoded string
+# parameter   dictionary encoded string
+# value_hrf   float64, null where the value isn't a number
+#
+# datasets are written as parquet when pyarrow is installed and as numpy .npz
+# files otherwise.
+import calendar
+import os
+import zipfile
+from collections import namedtuple
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+dictionary_columns = ['subsystem', 'sensor', 'parameter']
+
+if pyarrow is not None:
+    parquet_schema = pyarrow.schema([
+        ('timestamp', pyarrow.timestamp('s', tz='UTC')),
+        ('subsystem', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('sensor', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('parameter', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('value_hrf', pyarrow.float64()),
+    ])
+
+# codes index into values.
+DictionaryColumn = namedtuple('DictionaryColumn', ['codes', 'values'])
+
+
+def get_extension():
+    if pyarrow is not None:
+        return '.parquet'
+    return '.npz'
+
+
+def get_columnar_path(datasets_dir, node_id, date, extension=None):
+    if extension is None:
+        extension = get_extension()
+    return os.path.join(datasets_dir, node_id, date + extension)
+
+
+def get_epoch(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+# parses the '%Y/%m/%d %H:%M:%S' timestamps written to the csv datasets. slicing
+# is much faster than strptime for the number of samples in a node-day. returns
+# None for timestamps in any other format.
+def parse_timestamp(timestamp):
+    try:
+        return calendar.timegm((
+            int(timestamp[0:4]),
+            int(timestamp[5:7]),
+            int(timestamp[8:10]),
+            int(timestamp[11:13]),
+            int(timestamp[14:16]),
+            int(timestamp[17:19]),
+        ))
+    except (ValueError, TypeError):
+        return None
+
+
+def to_float(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    return None
+
+
+# writes a columnar dataset in row groups of at most row_group_size rows, so
+# memory use doesn't depend on the size of the node-day. dictionary codes are
+# shared by all row groups. the dataset is written to a temp file and renamed
+# once closed.
+class ColumnarWriter:
+
+    def __init__(self, path, row_group_size=65536):
+        self.path = path
+        self.temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        self.row_group_size = row_group_size
+        self.row_groups = 0
+        self.dictionaries = {name: {} for name in dictionary_columns}
+        self.clear()
+
+        if path.endswith('.parquet'):
+            self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, parquet_schema)
+        else:
+            self.writer = zipfile.ZipFile(self.temp_path, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def clear(self):
+        self.timestamps = []
+        self.values = []
+        self.codes = {name: [] for name in dictionary_columns}
+
+    def append(self, timestamp, subsystem, sensor, parameter, value_hrf):
+        self.timestamps.append(timestamp)
+
+        for name, value in zip(dictionary_columns, [subsystem, sensor, parameter]):
+            dictionary = self.dictionaries[name]
+            self.codes[name].append(dictionary.setdefault(value, len(dictionary)))
+
+        self.values.append(to_float(value_hrf))
+
+        if len(self.timestamps) >= self.row_group_size:
+            self.flush()
+
+    def get_dictionary(self, name):
+        return numpy.array(list(self.dictionaries[name]), dtype=str)
+
+    def get_arrays(self):
+        mask = numpy.fromiter((value is None for value in self.values), dtype=bool, count=len(self.values))
+        values = numpy.fromiter((0.0 if value is None else value for value in self.values), dtype=numpy.float64, count=len(self.values))
+
+        arrays = {
+            'timestamp': numpy.array(self.timestamps, dtype=numpy.int64),
+            'value_hrf': values,
+            'value_hrf_mask': mask,
+        }
+
+        for name in dictionary_columns:
+            arrays[name] = numpy.array(self.codes[name], dtype=numpy.int32)
+
+        return arrays
+
+    def write_npy(self, name, array):
+        with self.writer.open(name + '.npy', 'w', force_zip64=True) as file:
+            numpy.lib.format.write_array(file, array, allow_pickle=False)
+
+    def flush(self):
+        arrays = self.get_arrays()
+
+        if isinstance(self.writer, zipfile.ZipFile):
+            for name, array in arrays.items():
+                self.write_npy('{}.{}'.format(name, self.row_groups), array)
+        else:
+            columns = [pyarrow.array(arrays['timestamp'], type=parquet_schema.field('timestamp').type)]
+
+            for name in dictionary_columns:
+                columns.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(arrays[name], type=pyarrow.int32()),
+                    pyarrow.array(self.get_dictionary(name).tolist(), type=pyarrow.string())))
+
+            columns.append(pyarrow.array(arrays['value_hrf'], mask=arrays['value_hrf_mask']))
+
+            self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=parquet_schema))
+
+        self.row_groups += 1
+        self.clear()
+
+    def close(self):
+        try:
+            # an empty dataset still gets one empty row group.
+            if self.timestamps or self.row_groups == 0:
+                self.flush()
+
+            if isinstance(self.writer, zipfile.ZipFile):
+                for name in dictionary_columns:
+                    self.write_npy(name + '_values', self.get_dictionary(name))
+
+                self.write_npy('row_groups', numpy.array(self.row_groups))
+
+            self.writer.close()
+            os.replace(self.temp_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        try:
+            self.writer.close()
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+
+def read_parquet(path):
+    if pyarrow is None:
+        raise ImportError('pyarrow is required to read {}'.format(path))
+
+    # row groups may hold different dictionaries, which are merged before the
+    # chunks are combined.
+    table = pyarrow.parquet.read_table(path).unify_dictionaries()
+    columns = {}
+
+    # parquet has no seconds unit, so timestamps are read back as milliseconds.
+    timestamp = table.column('timestamp').combine_chunks().cast(parquet_schema.field('timestamp').type)
+    columns['timestamp'] = timestamp.cast(pyarrow.int64()).to_numpy()
+
+    for name in dictionary_columns:
+        column = table.column(name).combine_chunks()
+        columns[name] = DictionaryColumn(
+            column.indices.to_numpy(zero_copy_only=False).astype(numpy.int32),
+            column.dictionary.to_pylist())
+
+    value_hrf = table.column('value_hrf').combine_chunks()
+    columns['value_hrf'] = numpy.ma.array(
+        value_hrf.fill_null(0.0).to_numpy(),
+        mask=value_hrf.is_null().to_numpy(zero_copy_only=False))
+
+    return columns
+
+
+def read_npz(path):
+    with numpy.load(path) as arrays:
+        row_groups = range(int(arrays['row_groups']))
+
+        def read_column(name):
+            return numpy.concatenate([arrays['{}.{}'.format(name, i)] for i in row_groups])
+
+        columns = {}
+
+        columns['timestamp'] = read_column('timestamp')
+
+        for name in dictionary_columns:
+            columns[name] = DictionaryColumn(read_column(name), arrays[name + '_values'].tolist())
+
+        columns['value_hrf'] = numpy.ma.array(read_column('value_hrf'), mask=read_column('value_hrf_mask'))
+
+    return columns
+
+
+# returns a dict of columns. timestamp is an int64 array, value_hrf a float64
+# masked array and the dictionary encoded columns are DictionaryColumns.
+def read_columns(path):
+    if path.endswith('.parquet'):
+        return read_parquet(path)
+    return read_npz(path)
+
+
+# loads a node-day from a datasets tree in whichever format it was written.
+def load_day(datasets_dir, node_id, date):
+    for extension in ['.parquet', '.npz']:
+        path = get_columnar_path(datasets_dir, node_id, date, extension)
+
+        if os.path.exists(path):
+            return read_columns(path)
+
+    raise FileNotFoundError(get_columnar_path(datasets_dir, node_id, date))
+
+
+# expands a dictionary encoded column to an array of strings.
+def decode_column(column):
+    return numpy.array(column.values, dtype=object)[column.codes]
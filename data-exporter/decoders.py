@@ -0,0 +1,317 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+import configparser
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+logger = logging.getLogger('decoders')
+
+frame_header = struct.Struct('>I')
+
+
+class DecoderError(Exception):
+    pass
+
+
+def load_plugin_info(path):
+    executable = os.path.join(path, 'plugin_bin', 'plugin_beehive')
+
+    if not os.path.exists(executable):
+        raise FileNotFoundError(executable)
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(path, 'plugin.ver'))
+    section = config['plugin']
+
+    return {
+        'id': section['id'],
+        'version': section['version'],
+        'executable': executable,
+        'stream': section.getboolean('beehive_stream', fallback=False),
+    }
+
+
+def load_plugins(paths):
+    plugins = {}
+
+    for path in map(os.path.abspath, paths):
+        logger.info('Loading plugin %s.', path)
+
+        try:
+            info = load_plugin_info(path)
+        except FileNotFoundError:
+            logger.warning('Invalid plugin at %s.', path)
+            continue
+
+        plugins[(info['id'], info['version'])] = info
+
+    return plugins
+
+
+# writes chunks to a decoder's stdin from a separate thread, so a decoder which
+# starts writing output before reading all of its input can't deadlock us.
+def start_feeding(stdin, chunks, header=None, close=True):
+    def feed():
+        try:
+            if header is not None:
+                stdin.write(header)
+
+            for chunk in chunks:
+                stdin.write(chunk)
+
+            if close:
+                stdin.close()
+            else:
+                stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    return thread
+
+
+# yields the items of a JSON array as they are read from stream instead of
+# loading the whole array at once.
+def iter_json_array(stream, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise DecoderError('decoder output is not a JSON array')
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ']':
+                return
+
+            if buf[pos] == ',':
+                pos += 1
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise DecoderError('invalid decoder output')
+                end = None
+
+            # an item ending at the end of the buffer may be a truncated number
+            # or literal, so it's only accepted once more data follows.
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            raise DecoderError('decoder output ended before end of array')
+
+        data = stream.read(chunk_size)
+
+        if not data:
+            eof = True
+
+        buf = buf[pos:] + data
+        pos = 0
+
+
+# runs a new decoder process for a single request. the whole input is written
+# to stdin and the output is a JSON array of rows.
+def decode_once(executable, chunks):
+    process = subprocess.Popen([executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    feeder = start_feeding(process.stdin, chunks)
+
+    try:
+        yield from iter_json_array(io.TextIOWrapper(process.stdout, encoding='utf-8'))
+    finally:
+        process.stdout.close()
+
+        if process.poll() is None:
+            process.kill()
+
+        process.wait()
+        feeder.join()
+
+    if process.returncode != 0:
+        raise DecoderError('decoder exited with {}'.format(process.returncode))
+
+
+# long lived decoder for plugins with beehive_stream set in plugin.ver. the
+# executable is run with --stream and handles requests one after another:
+#
+# request:  4 byte big endian length followed by that many bytes of input
+# response: one JSON row per line, followed by an empty line
+#
+# a decoder which exits or is left mid response is killed and started again on
+# the next request.
+class StreamDecoder:
+
+    def __init__(self, executable):
+        self.executable = executable
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([self.executable, '--stream'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            self.process.kill()
+
+        self.process.wait()
+
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        self.process.stdout.close()
+        self.process = None
+
+    def decode(self, chunks):
+        if self.process is not None and self.process.poll() is not None:
+            logger.warning('Decoder %s exited with %s. Restarting.', self.executable, self.process.returncode)
+            self.stop()
+
+        if self.process is None:
+            self.start()
+
+        chunks = list(chunks)
+        header = frame_header.pack(sum(map(len, chunks)))
+        feeder = start_feeding(self.process.stdin, chunks, header=header, close=False)
+        complete = False
+
+        try:
+            for line in self.process.stdout:
+                if line == b'\n':
+                    complete = True
+                    break
+
+                yield json.loads(line)
+        finally:
+            if not complete:
+                self.stop()
+            feeder.join()
+
+        if not complete:
+            raise DecoderError('decoder {} exited mid response'.format(self.executable))
+
+
+class DecoderPool:
+
+    def __init__(self, plugins):
+        self.plugins = plugins
+        self.decoders = {}
+
+    def __contains__(self, plugin):
+        return plugin in self.plugins
+
+    # returns an iterator over the rows decoded from chunks. rows should be
+    # consumed before the next call for the same plugin.
+    def decode(self, plugin, chunks):
+        info = self.plugins[plugin]
+
+        if not info['stream']:
+            return decode_once(info['executable'], chunks)
+
+        if plugin not in self.decoders:
+            self.decoders[plugin] = StreamDecoder(info['executable'])
+
+        return self.decoders[plugin].decode(chunks)
+
+    def close(self):
+        for decoder in self.decoders.values():
+            decoder.stop()
+
+        self.decoders = {}
+
+
+def format_row(node_id, sdf, row):
+    sensor, parameter = sdf.lookup(row['sensor'], row['parameter'])
+    ts = datetime.datetime.utcfromtimestamp(row['timestamp'])
+
+    return [
+        ts.strftime('%Y/%m/%d %H:%M:%S'),
+        node_id,
+        row['subsystem'],
+        sensor,
+        parameter,
+        row['value_raw'],
+        row['value_hrf'],
+    ]
+
+
+# decodes the data of each plugin and writes the rows to file as a gzipped csv
+# member as they're produced.
+def write_rows(file, node_id, sdf, pool, results_by_plugin):
+    with gzip.GzipFile(filename='', mode='wb', fileobj=file) as gzip_file:
+        with io.TextIOWrapper(gzip_file, encoding='utf-8', newline='') as text_file:
+            writer = csv.writer(text_file)
+
+            for plugin, results in results_by_plugin.items():
+                if plugin not in pool:
+                    logger.warning('No plugin with ID %s and version %s.', *plugin)
+                    continue
+
+                for row in pool.decode(plugin, results):
+                    writer.writerow(format_row(node_id, sdf, row))
+
+
+# the dataset is written to a temp file and renamed once complete.
+def write_dataset(path, node_id, sdf, pool, results_by_plugin):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    try:
+        with open(temp_path, 'wb') as file:
+            write_rows(file, node_id, sdf, pool, results_by_plugin)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# appends rows to an existing dataset as a new gzip member, which gzip readers
+# concatenate with the earlier ones. the dataset is first truncated to offset,
+# the end of the last complete member, dropping any partially written append.
+# returns the new end of the dataset.
+def append_dataset(path, offset, node_id, sdf, pool, results_by_plugin):
+    with open(path, 'r+b') as file:
+        file.truncate(offset)
+        file.seek(offset)
+
+        try:
+            write_rows(file, node_id, sdf, pool, results_by_plugin)
+        except BaseException:
+            file.truncate(offset)
+            raise
+
+        file.flush()
+        os.fsync(file.fileno())
+        return file.tell()
@@ -0,0 +1,78 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+#
+# dataset_partitions is maintained by the loaders and lists the (node_id, date)
+# partitions of each data table. it's partitioned by month and clustered by
+# date, so date ranges can be read without scanning the data tables.
+
+
+def get_month(date):
+    return date[:7]
+
+
+def iter_months(since, until):
+    year, month = map(int, get_month(since).split('-'))
+    last = get_month(until)
+
+    while True:
+        current = '{:04d}-{:02d}'.format(year, month)
+
+        if current > last:
+            break
+
+        yield current
+
+        month += 1
+
+        if month > 12:
+            year += 1
+            month = 1
+
+
+def get_index_months(session, table, since=None, until=None):
+    if since is not None and until is not None:
+        return list(iter_months(since, until))
+
+    # the index is small, so listing its partitions is cheap.
+    months = set()
+
+    for row in session.execute('SELECT DISTINCT table_name, month FROM dataset_partitions'):
+        if row.table_name != table:
+            continue
+        if since is not None and row.month < get_month(since):
+            continue
+        if until is not None and row.month > get_month(until):
+            continue
+        months.add(row.month)
+
+    return sorted(months)
+
+
+def list_partitions(session, table, since=None, until=None, node=None):
+    query = 'SELECT node_id, date FROM dataset_partitions WHERE table_name=%s AND month=%s'
+    params = []
+
+    if since is not None:
+        query += ' AND date >= %s'
+        params.append(since)
+
+    if until is not None:
+        query += ' AND date <= %s'
+        params.append(until)
+
+    # node ids may be stored with a prefix and in either case, so node can't
+    # be matched by the query. it's filtered here instead.
+    if node is not None:
+        node = node[-12:].lower()
+
+    for month in get_index_months(session, table, since, until):
+        for row in session.execute(query, [table, month] + params):
+            if node is not None and row.node_id[-12:].lower() != node:
+                continue
+
+            yield row.node_id, row.date
+
@@ -0,0 +1,41 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+import os
+
+
+def get_dataset_path(datasets_dir, node_id, date):
+    return os.path.join(datasets_dir, node_id, date + '.csv.gz')
+
+
+# the size of a node-day's previous export, from sizes (eg. a manifest) or the
+# dataset itself, is used as an estimate of how long its job will take. None if
+# it hasn't been exported before.
+def get_previous_size(datasets_dir, node_id, date, sizes=None):
+    if sizes is not None and (node_id, date) in sizes:
+        return sizes[(node_id, date)]
+
+    try:
+        return os.path.getsize(get_dataset_path(datasets_dir, node_id, date))
+    except FileNotFoundError:
+        return None
+
+
+# orders jobs largest first, so the longest jobs start right away instead of
+# leaving a single worker running alone at the end of the export. jobs which
+# haven't been exported before are assumed to be of average size, so they
+# aren't all left until the end. get_index returns a job's (node_id, date).
+def sort_largest_first(jobs, datasets_dir, get_index, sizes=None):
+    job_sizes = [get_previous_size(datasets_dir, *get_index(job), sizes) for job in jobs]
+    known_sizes = [size for size in job_sizes if size is not None]
+
+    if known_sizes:
+        default_size = sum(known_sizes) / len(known_sizes)
+    else:
+        default_size = 0
+
+    order = sorted(range(len(jobs)), key=lambda i: default_size if job_sizes[i] is None else job_sizes[i], reverse=True)
+    return [jobs[i] for i in order]
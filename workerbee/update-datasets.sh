@@ -15,5 +15,5 @@ function cleanup {
 ssh -O check beehive1-proxy || ssh -fN beehive1-proxy
 trap cleanup EXIT
 
-list-datasets | filter-last-day | export-datasets -p 8 $DATASETS_DIR
+list-datasets --last day | export-datasets -p 8 --manifest $DATASETS_DIR/manifest.db $DATASETS_DIR
 find $DATASETS_DIR -name '2036*.csv.gz' | xargs rm